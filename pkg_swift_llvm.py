@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import errno
+import hashlib
+import importlib.util
+import multiprocessing
 import os
 import pathlib
 import platform
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import zipfile
 import zlib
 from collections import namedtuple
 
@@ -21,13 +29,25 @@ def getoptions():
 
     default_output = f"swift-prebuilt-{get_platform()}"
     parser.add_argument("--output", "-o", type=pathlib.Path, metavar="DIR_OR_ZIP",
-                        help="output zip file or directory "
+                        help="output archive file or directory "
                              f"(by default the filename is {default_output})")
 
+    parser.add_argument("--compression-level", type=int, choices=range(10), default=1, metavar="LEVEL",
+                        help="deflate compression level of zip and tar.gz archives (default 1, favouring speed)")
+    parser.add_argument("--force-reconfigure", action="store_true",
+                        help="always configure the dummy cmake project, ignoring cached linking information")
+    parser.add_argument("--archive-format", action="append", choices=ARCHIVERS, metavar="FORMAT",
+                        help="archive format(s) to produce, can be repeated (default zip, choices: "
+                             f"{', '.join(ARCHIVERS)}; tar.zst requires the zstandard module)")
+
     opts = parser.parse_args()
     if opts.output is None:
         opts.output = pathlib.Path()
     opts.output = get_tgt(opts.output, default_output)
+    if opts.archive_format is None:
+        opts.archive_format = ["zip"]
+    if "tar.zst" in opts.archive_format and importlib.util.find_spec("zstandard") is None:
+        parser.error("tar.zst archives require the zstandard module")
 
     return opts
 
@@ -36,50 +56,108 @@ EXPORTED_LIB = "CodeQLSwiftFrontendTool"
 
 Libs = namedtuple("Libs", ("static", "shared", "linker_flags"))
 
+LINK_TXT = pathlib.Path("CMakeFiles", "codeql-swift-artifacts.dir", "link.txt")
+
 
 def resolve(p):
     return pathlib.Path(p).resolve()
 
 
-def run(prog, *, cwd, env=None, input=None):
+def run(prog, *, cwd, env=None, stdin=None):
     print("running", *prog, f"(cwd={cwd})")
     if env is not None:
         runenv = dict(os.environ)
         runenv.update(env)
     else:
         runenv = None
-    subprocess.run(prog, cwd=cwd, env=runenv, input=input, text=True, check=True)
+    subprocess.run(prog, cwd=cwd, env=runenv, stdin=stdin, check=True)
+
+
+def _link_or_copy(src, dst):
+    # exported files are only read afterwards, so a hard link is as good as a copy
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        shutil.copy(src, dst)
+
+
+_PLATFORM = "linux" if platform.system() == "Linux" else "macos"
+_IS_LINUX = sys.platform == 'linux'
 
 
 def get_platform():
-    return "linux" if platform.system() == "Linux" else "macos"
+    return _PLATFORM
+
 
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        try:
+            cache_home = pathlib.Path.home() / ".cache"
+        except RuntimeError:
+            # no HOME and no passwd entry, as in some CI containers: do without a cache
+            return None
+    return pathlib.Path(cache_home) / "pkg_swift_llvm"
 
-def configure_dummy_project(tmp, prefixes):
+
+def configure_dummy_project(tmp, prefixes, generated=(), force=False):
     print("configuring dummy cmake project")
     script_dir = pathlib.Path(os.path.realpath(__file__)).parent
     print(script_dir)
-    shutil.copy(script_dir / "CMakeLists.txt", tmp / "CMakeLists.txt")
-    shutil.copy(script_dir / "empty.cpp", tmp / "empty.cpp")
-    shutil.copy(script_dir / "CodeQLSwiftVersion.h.in", tmp / "CodeQLSwiftVersion.h.in")
+    inputs = [script_dir / f for f in ("CMakeLists.txt", "empty.cpp", "CodeQLSwiftVersion.h.in")]
+    for f in inputs:
+        shutil.copy(f, tmp / f.name)
     tgt = tmp / "build"
     tgt.mkdir()
+    # On Linux link.txt only depends on the prefixes and on the project files, reuse it if none of those
+    # changed and the files cmake generates outside of the build dir are still there. On macOS it also
+    # depends on the Xcode toolchain and SDK, so always configure there.
+    cached = None
+    cache_dir = get_cache_dir() if _IS_LINUX else None
+    if cache_dir is not None:
+        key = hashlib.sha256()
+        for p in prefixes:
+            key.update(f"{p}\0".encode())
+        for f in inputs:
+            key.update(f.read_bytes())
+        cached = cache_dir / key.hexdigest() / "link.txt"
+        inputs += [p / "CMakeCache.txt" for p in prefixes if (p / "CMakeCache.txt").exists()]
+    if (cached is not None and not force and cached.exists() and all(f.exists() for f in generated)
+            and cached.stat().st_mtime > max(f.stat().st_mtime for f in inputs)):
+        print(f"reusing {cached}")
+        (tgt / LINK_TXT).parent.mkdir(parents=True)
+        shutil.copy(cached, tgt / LINK_TXT)
+        return tgt
     prefixes = ';'.join(str(p) for p in prefixes)
     run(["cmake", f"-DCMAKE_PREFIX_PATH={prefixes}", "-DBUILD_SHARED_LIBS=OFF", ".."], cwd=tgt)
+    if cached is not None:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        # write atomically, so interrupted or concurrent runs never leave a truncated cache behind
+        fd, tmpfile = tempfile.mkstemp(dir=cached.parent)
+        os.close(fd)
+        try:
+            shutil.copyfile(tgt / LINK_TXT, tmpfile)
+            os.replace(tmpfile, cached)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
     return tgt
 
 
 def get_libs(configured):
     print("extracting linking information from dummy project")
-    with open(configured / "CMakeFiles" / "codeql-swift-artifacts.dir" / "link.txt") as link:
+    with open(configured / LINK_TXT) as link:
         libs = link.read().split()
         libs = libs[libs.index('codeql-swift-artifacts') + 1:]  # skip up to -o dummy
     ret = Libs([], [], [])
+    configured = configured.absolute()  # joining an absolute path keeps it absolute
+    lib_lists = {"a": ret.static, "so": ret.shared, "tbd": ret.shared, "dylib": ret.shared}
     for l in libs:
-        if l.endswith(".a"):
-            ret.static.append((configured / l).absolute())
-        elif l.endswith(".so") or l.endswith(".tbd") or l.endswith(".dylib"):
-            ret.shared.append((configured / l).absolute())
+        lib_list = lib_lists.get(l.rpartition(".")[2])
+        if lib_list is not None:
+            lib_list.append(configured / l)
         elif l.startswith(("-L", "-Wl", "-l")) or l == "-pthread":
             ret.linker_flags.append(l)
         else:
@@ -96,10 +174,15 @@ def get_tgt(tgt, filename):
 def create_static_lib(tgt, libs):
     tgt = get_tgt(tgt, f"lib{EXPORTED_LIB}.a")
     print(f"packaging {tgt.name}")
-    if sys.platform == 'linux':
-        includedlibs = "\n".join(f"addlib {l}" for l in libs.static)
-        mriscript = f"create {tgt}\n{includedlibs}\nsave\nend"
-        run(["ar", "-M"], cwd=tgt.parent, input=mriscript)
+    if _IS_LINUX:
+        # hand the MRI script to ar as a file rather than building it in memory
+        # (thin archives would be faster, but the exported library must be self-contained)
+        with tempfile.TemporaryFile() as mriscript:
+            mriscript.write(f"create {tgt}\n".encode())
+            mriscript.writelines(f"addlib {l}\n".encode() for l in libs.static)
+            mriscript.write(b"save\nend\n")
+            mriscript.seek(0)
+            run(["ar", "-M"], cwd=tgt.parent, stdin=mriscript)
     else:
         libtool_args = ["libtool", "-static"]
         libtool_args.extend(libs.static)
@@ -109,15 +192,40 @@ def create_static_lib(tgt, libs):
     return tgt
 
 
-def copy_includes(src, tgt):
-    print(f"copying includes from {src}")
-    for dir, exts in (("include", ("h", "def", "inc")), ("stdlib", ("h",))):
-        srcdir = src / dir
-        for ext in exts:
-            for srcfile in srcdir.rglob(f"*.{ext}"):
-                tgtfile = tgt / dir / srcfile.relative_to(srcdir)
-                tgtfile.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy(srcfile, tgtfile)
+def find_files(srcdir, exts):
+    # yields (path, path relative to srcdir) pairs, sticking to plain strings for speed
+    srcdir = str(srcdir)
+    if not os.path.isdir(srcdir):
+        return
+    for dirpath, _, filenames, _ in os.fwalk(srcdir):
+        reldir = dirpath[len(srcdir) + 1:]
+        for name in filenames:
+            if name.endswith(exts):
+                yield os.path.join(dirpath, name), os.path.join(reldir, name)
+
+
+def find_includes(src, files):
+    print(f"looking for includes in {src}")
+    for dir, exts in (("include", (".h", ".def", ".inc")), ("stdlib", (".h",))):
+        for srcfile, relfile in find_files(src / dir, exts):
+            files[os.path.join(dir, relfile)] = srcfile
+
+
+def copy_files(files, tgt):
+    # only create the leaf directories, makedirs takes care of their ancestors
+    dirs = {os.path.dirname(tgtfile) for tgtfile in files}
+    ancestors = set()
+    for d in dirs:
+        d = os.path.dirname(d)
+        while d and d not in ancestors:
+            ancestors.add(d)
+            d = os.path.dirname(d)
+    for d in dirs - ancestors:
+        os.makedirs(tgt / d, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for future in [executor.submit(_link_or_copy, srcfile, tgt / tgtfile) for tgtfile, srcfile in files.items()]:
+            future.result()
+
 
 def export_stdlibs(exported_dir, swift_build_tree):
     ext = 'dylib'
@@ -155,34 +263,120 @@ def export_headers(exported_dir, swift_source_tree, llvm_build_tree, swift_build
     clang_tools_build_tree = llvm_build_tree / 'tools/clang'
     header_dirs = [llvm_source_tree, clang_source_tree, swift_source_tree, llvm_build_tree, swift_build_tree,
                    clang_tools_build_tree]
+    # later directories take precedence over earlier ones
+    files = {}
     for h in header_dirs:
-        copy_includes(h, exported_dir)
+        find_includes(h, files)
+    print(f"copying {len(files)} headers")
+    copy_files(files, exported_dir)
 
 
-def zip_dir(src, tgt):
+def zip_dir(src, tgt, compression_level):
     tgt = get_tgt(tgt, f"swift-prebuilt-{get_platform()}.zip")
     print(f"compressing {src.name} to {tgt}")
-    archive = shutil.make_archive(tgt, 'zip', src)
+    archive = tgt.with_name(f"{tgt.name}.zip")
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compression_level) as zf:
+        for dirpath, dirnames, filenames in os.walk(src):
+            dirpath = pathlib.Path(dirpath)
+            for name in sorted(dirnames) + sorted(filenames):
+                path = dirpath / name
+                zf.write(path, path.relative_to(src))
+    print(f"created {archive}")
+
+
+def zstd_dir(src, tgt, compression_level=3):
+    import zstandard
+
+    tgt = get_tgt(tgt, f"swift-prebuilt-{get_platform()}.tar.zst")
+    print(f"compressing {src.name} to {tgt}")
+    archive = tgt.with_name(f"{tgt.name}.tar.zst")
+    cctx = zstandard.ZstdCompressor(level=compression_level, threads=-1)
+    with open(archive, "wb") as out, cctx.stream_writer(out) as compressed:
+        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+            for path in sorted(src.iterdir()):
+                tar.add(path, arcname=path.name)
     print(f"created {archive}")
 
 
+def tar_dir(src, tgt, compression_level):
+    tgt = get_tgt(tgt, f"swift-prebuilt-{get_platform()}.tar.gz")
+    print(f"compressing {src.name} to {tgt}")
+    archive = tgt.with_name(f"{tgt.name}.tar.gz")
+    members = sorted(p.name for p in src.iterdir())
+    if shutil.which("pigz"):
+        # pigz produces the same format as gzip, using all cores
+        run(["tar", f"--use-compress-program=pigz -{compression_level}", "-cf", str(archive), *members], cwd=src)
+    else:
+        with tarfile.open(archive, "w:gz", compresslevel=compression_level) as tar:
+            for name in members:
+                tar.add(src / name, arcname=name)
+    print(f"created {archive}")
+
+
+ARCHIVERS = {
+    "zip": lambda src, tgt, opts: zip_dir(src, tgt, opts.compression_level),
+    "tar.gz": lambda src, tgt, opts: tar_dir(src, tgt, opts.compression_level),
+    "tar.zst": lambda src, tgt, opts: zstd_dir(src, tgt),
+}
+
+
+def create_archive(fmt, src, opts):
+    ARCHIVERS[fmt](src, opts.output, opts)
+
+
+def archive(src, opts):
+    formats = list(dict.fromkeys(opts.archive_format))
+    if len(formats) == 1:
+        create_archive(formats[0], src, opts)
+        return
+    # compression is CPU bound, so produce the different formats in separate processes
+    # (spawned rather than forked, as background cleanup threads may be running)
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=create_archive, args=(fmt, src, opts)) for fmt in formats]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    failed = [fmt for fmt, w in zip(formats, workers) if w.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"failed to create {', '.join(failed)} archive")
+
+
+def remove_dirs(dirs):
+    for d in dirs:
+        shutil.rmtree(d, ignore_errors=True)
+
+
 def main(opts):
     tmp = pathlib.Path('/tmp/llvm-swift')
     if os.path.exists(tmp):
-        shutil.rmtree(tmp)
+        # move the previous run out of the way and delete it in the background
+        old = tempfile.mkdtemp(prefix=f"{tmp.name}.old-", dir=tmp.parent)
+        os.rename(tmp, os.path.join(old, tmp.name))
     os.mkdir(tmp)
+    stale = list(tmp.parent.glob(f"{tmp.name}.old-*"))
+    cleanup = threading.Thread(target=remove_dirs, args=(stale,))
+    cleanup.start()
     llvm_build_tree = next(opts.build_tree.glob("llvm-*"))
     swift_build_tree = next(opts.build_tree.glob("swift-*"))
     configured = configure_dummy_project(tmp, prefixes=[llvm_build_tree, swift_build_tree,
-                                                        swift_build_tree / 'cmake' / 'modules'])
+                                                        swift_build_tree / 'cmake' / 'modules'],
+                                         generated=[swift_build_tree / 'include/swift/CodeQLSwiftVersion.h'],
+                                         force=opts.force_reconfigure)
     libs = get_libs(configured)
 
     exported = tmp / "exported"
     exported.mkdir()
-    export_libs(exported, libs, swift_build_tree)
-    export_headers(exported, opts.swift_source_tree, llvm_build_tree, swift_build_tree)
-
-    zip_dir(exported, opts.output)
+    # libraries and headers end up in disjoint parts of the exported tree, so export them in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        exports = [executor.submit(export_libs, exported, libs, swift_build_tree),
+                   executor.submit(export_headers, exported, opts.swift_source_tree, llvm_build_tree,
+                                   swift_build_tree)]
+        for future in exports:
+            future.result()
+
+    archive(exported, opts)
+    cleanup.join()
 
 
 if __name__ == "__main__":